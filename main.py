@@ -1,8 +1,14 @@
 import os
+import argparse
+import pathlib
 import requests
+import io
 import base64
+import hashlib
+import json
+import pandas as pd
 import yfinance as yf
-from datetime import datetime
+from datetime import date
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -12,72 +18,281 @@ repo = 'awakzdev/finance'
 branch = 'main'
 
 # Step 1: Fetch today's date in the format day/month/year
-today_date = datetime.now().strftime('%Y-%m-%d')
+today_date = date.today().isoformat()
 
 # Symbols to process
 symbols = ['QLD', '^NDX']
 
-for symbol in symbols:
-    # Step 2: Fetch historical data for the symbol
-    data = yf.download(symbol, start='2006-06-21', end=today_date)
-    # Was previously - 2019-07-26
-
-    # Convert the index (dates) to the desired format (day/month/year)
-    data.index = data.index.strftime('%d/%m/%Y')
-
-    # Step 3: Save the data to a CSV file with the symbol as a prefix
-    csv_filename = f'{symbol.lower()}_stock_data.csv'
-    data.to_csv(csv_filename)
-    file_path_in_repo = csv_filename  # Use the same name for GitHub
-
-    # Step 4: Get the current file's SHA (needed to update a file in the repository)
-    url = f'https://api.github.com/repos/{repo}/contents/{file_path_in_repo}'
-    headers = {'Authorization': f'token {github_token}'}
-
-    try:
-        # Try to get the file's SHA
-        response = requests.get(url, headers=headers)
-        response_json = response.json()
-
-        if response.status_code == 200:
-            # File exists, extract the SHA
-            sha = response_json['sha']
-            print(f'File {file_path_in_repo} exists, updating it.')
-        elif response.status_code == 404:
-            # File does not exist, we'll create a new one
-            sha = None
-            print(f'File {file_path_in_repo} does not exist, creating a new one.')
+# History starts here; was previously - 2019-07-26
+start_date = '2006-06-21'
+
+# Columns index.html reads from the published CSVs (besides the Date index)
+required_columns = ['Open', 'High', 'Low', 'Close']
+
+# Local Parquet cache of downloaded history, so repeat runs only fetch new bars
+cache_dir = '.cache'
+
+# Cached bars downloaded again on every run to detect upstream rewrites
+overlap_bars = 5
+
+# Blob SHAs of the CSVs as of the last run that left GitHub up to date. Kept inside cache_dir
+# on purpose: whenever the history cache is rebuilt, the next run checks GitHub again.
+last_push_path = os.path.join(cache_dir, 'last_push.json')
+
+graphql_url = 'https://api.github.com/graphql'
+
+
+def csv_path(symbol):
+    # Same name locally (--keep-local) and in the repository
+    return f'{symbol.lower()}_stock_data.csv'
+
+
+def cache_path(symbol):
+    return os.path.join(cache_dir, f'{symbol.lower()}.parquet')
+
+
+def download(symbols, start):
+    # One batched request for all symbols, split back into a flat-column frame per symbol
+    # auto_adjust=False keeps the raw Close the published CSVs have always had
+    data = yf.download(symbols, start=start, end=today_date, group_by='ticker', threads=True,
+                       auto_adjust=False, progress=False)
+    if not isinstance(data.columns, pd.MultiIndex):
+        # Older yfinance returns flat columns when only one symbol is requested
+        return {symbols[0]: data}
+    tickers = data.columns.get_level_values(0)
+    return {symbol: data[symbol].dropna(how='all') for symbol in symbols if symbol in tickers}
+
+
+def history_rewritten(cached, new):
+    # Yahoo back-adjusts the whole history after a split and corrects recent bars,
+    # so cached bars that no longer match a fresh download can't be extended
+    common = cached.index.intersection(new.index)
+    if common.empty:
+        return True
+    old = cached.loc[common, required_columns]
+    fresh = new.loc[common, required_columns]
+    return bool(((old - fresh).abs() > 1e-6 * fresh.abs()).any().any())
+
+
+def fetch_history(symbols):
+    histories = {}
+    starts = {}
+    for symbol in symbols:
+        if os.path.exists(cache_path(symbol)):
+            histories[symbol] = pd.read_parquet(cache_path(symbol))
+            # Symbols whose cache already covers everything up to today need no download
+            if (histories[symbol].index.max() + pd.Timedelta(days=1)).strftime('%Y-%m-%d') < today_date:
+                # Re-download the last cached bars too, to check them against Yahoo's current values
+                starts[symbol] = histories[symbol].index[-overlap_bars:].min().strftime('%Y-%m-%d')
         else:
-            # Other errors
-            print(f'Unexpected error: {response_json}')
+            starts[symbol] = start_date
+
+    stale = [symbol for symbol in symbols if symbol in starts]
+    if not stale:
+        return histories
+
+    if start_date in starts.values():
+        # A cold cache can't vouch for what the last run pushed
+        forget_last_push()
+
+    downloads = download(stale, min(starts[symbol] for symbol in stale))
+    refresh = []
+    os.makedirs(cache_dir, exist_ok=True)
+    for symbol in stale:
+        new = downloads.get(symbol)
+        if new is None or new.empty:
             continue
-    except Exception as e:
-        print(f'Error fetching file info for {symbol}: {e}')
-        continue
-
-    # Step 5: Read the new CSV file and encode it in base64
-    with open(csv_filename, 'rb') as f:
-        content = f.read()
-    content_base64 = base64.b64encode(content).decode('utf-8')
-
-    # Step 6: Create the payload for the GitHub API request
-    commit_message = f'Update {symbol} stock data'
-    data = {
-        'message': commit_message,
-        'content': content_base64,
-        'branch': branch
+        cached = histories.get(symbol)
+        if cached is not None and new.index.min() > cached.index.min():
+            if history_rewritten(cached, new):
+                refresh.append(symbol)
+                continue
+            new = pd.concat([cached, new])
+            new = new[~new.index.duplicated(keep='last')]
+        new.to_parquet(cache_path(symbol), compression='zstd')
+        histories[symbol] = new
+
+    if refresh:
+        # Start these symbols over from the full history
+        print(f'Cached history changed upstream for {", ".join(refresh)}, downloading it again.')
+        forget_last_push()
+        downloads = download(refresh, start_date)
+        for symbol in refresh:
+            new = downloads.get(symbol)
+            if new is None or new.empty:
+                # Never publish a mix of old and new bars; drop the symbol for this run
+                del histories[symbol]
+                continue
+            new.to_parquet(cache_path(symbol), compression='zstd')
+            histories[symbol] = new
+
+    return histories
+
+
+def git_blob_sha(content):
+    # Same SHA1 git (and the contents API) assigns to a blob with these bytes
+    return hashlib.sha1(b'blob %d\x00' % len(content) + content).hexdigest()
+
+
+def load_last_push():
+    if not os.path.exists(last_push_path):
+        return {}
+    with open(last_push_path) as f:
+        return json.load(f)
+
+
+def forget_last_push():
+    if os.path.exists(last_push_path):
+        os.remove(last_push_path)
+
+
+def save_last_push(shas):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(last_push_path, 'w') as f:
+        json.dump(shas, f, indent=2)
+
+
+def graphql(session, query, variables):
+    response = session.post(graphql_url, json={'query': query, 'variables': variables})
+    response_json = response.json()
+    # GraphQL reports most failures in 'errors' with a 200 status
+    if response.status_code != 200 or response_json.get('errors'):
+        raise RuntimeError(f'Unexpected error: {response_json}')
+    return response_json['data']
+
+
+def get_branch_state(session, paths):
+    # Head commit of the branch and the blob SHA of every path, in a single query
+    owner, name = repo.split('/')
+    variables = {'owner': owner, 'name': name, 'ref': f'refs/heads/{branch}'}
+    declarations = ''
+    fields = ''
+    for i, path in enumerate(paths):
+        variables[f'expr{i}'] = f'{branch}:{path}'
+        declarations += f', $expr{i}: String!'
+        fields += f'file{i}: object(expression: $expr{i}) {{ oid }}\n'
+    query = f"""
+    query($owner: String!, $name: String!, $ref: String!{declarations}) {{
+      repository(owner: $owner, name: $name) {{
+        ref(qualifiedName: $ref) {{ target {{ oid }} }}
+        {fields}
+      }}
+    }}
+    """
+    repository = graphql(session, query, variables)['repository']
+
+    head_oid = repository['ref']['target']['oid']
+    # A missing file comes back as null
+    shas = {path: (repository[f'file{i}'] or {}).get('oid') for i, path in enumerate(paths)}
+    return head_oid, shas
+
+
+def commit_files(session, head_oid, files, commit_message):
+    # All files go into one commit; expectedHeadOid makes it fail rather than overwrite a newer head
+    query = """
+    mutation($input: CreateCommitOnBranchInput!) {
+      createCommitOnBranch(input: $input) { commit { oid } }
     }
+    """
+    additions = [
+        {'path': path, 'contents': base64.b64encode(content).decode('ascii')}
+        for path, content in files.items()
+    ]
+    variables = {'input': {
+        'branch': {'repositoryNameWithOwner': repo, 'branchName': branch},
+        'message': {'headline': commit_message},
+        'fileChanges': {'additions': additions},
+        'expectedHeadOid': head_oid,
+    }}
+    return graphql(session, query, variables)['createCommitOnBranch']['commit']['oid']
+
+
+def build_csv(symbol, data, path, keep_local=False):
+    # Validate the data in memory before it is written, instead of re-reading the CSV
+    missing_columns = [column for column in required_columns if column not in data.columns]
+    if data.empty or missing_columns:
+        print(f'Invalid data for {symbol}: {len(data)} rows, missing columns {missing_columns}')
+        return None
+
+    # Only publish what index.html reads, a smaller CSV means a smaller upload
+    data = data[required_columns]
+
+    # Step 3: Serialize the data to CSV in memory
+    # Dates are written day/month/year and prices rounded by pandas' CSV writer in the same pass
+    buffer = io.BytesIO()
+    data.to_csv(buffer, float_format='%.4f', date_format='%d/%m/%Y')
+    content = buffer.getvalue()
+
+    # Only keep a copy on disk when asked to, the upload works from memory
+    if keep_local:
+        pathlib.Path(path).write_bytes(content)
+
+    return content
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update stock data CSVs in the GitHub repository.')
+    parser.add_argument('--keep-local', action='store_true', help='also write the CSV files to the working directory')
+    args = parser.parse_args()
+
+    # Step 2: Fetch historical data for all symbols (cached, only new bars are downloaded)
+    histories = fetch_history(symbols)
+
+    files = {}
+    symbol_by_path = {}
+    for symbol in symbols:
+        file_path_in_repo = csv_path(symbol)
+        content = build_csv(symbol, histories.get(symbol, pd.DataFrame()), file_path_in_repo, args.keep_local)
+        if content is not None:
+            files[file_path_in_repo] = content
+            symbol_by_path[file_path_in_repo] = symbol
+
+    if not files:
+        return
+
+    # Skip the network entirely when every CSV is byte-identical to what the last run left on GitHub
+    local_shas = {path: git_blob_sha(content) for path, content in files.items()}
+    if local_shas == load_last_push():
+        print('No changes since the last run, skipping upload.')
+        return
+
+    # One keep-alive session for both GitHub calls, so the commit reuses the query's TLS connection
+    with requests.Session() as session:
+        session.headers.update({'Authorization': f'token {github_token}'})
+
+        # Step 4: Get the branch head and the current SHA of every file
+        try:
+            head_oid, shas = get_branch_state(session, list(files))
+        except Exception as e:
+            print(f'Error fetching file info: {e}')
+            return
+
+        for file_path_in_repo in list(files):
+            if shas[file_path_in_repo] == local_shas[file_path_in_repo]:
+                # Remote file already has these exact bytes, nothing to commit for it
+                print(f'File {file_path_in_repo} is unchanged, skipping upload.')
+                del files[file_path_in_repo]
+            elif shas[file_path_in_repo]:
+                print(f'File {file_path_in_repo} exists, updating it.')
+            else:
+                print(f'File {file_path_in_repo} does not exist, creating a new one.')
+
+        if not files:
+            save_last_push(local_shas)
+            return
+
+        # Step 5: Push every changed file to the repository in a single commit
+        commit_message = f'Update {", ".join(symbol_by_path[path] for path in files)} stock data'
+        try:
+            commit_oid = commit_files(session, head_oid, files, commit_message)
+        except Exception as e:
+            print(f'Failed to update {", ".join(files)} in the repository.')
+            print('Response:', e)
+            return
 
-    # Include the SHA if the file exists (for updating)
-    if sha:
-        data['sha'] = sha
+        print(f'Files {", ".join(files)} updated successfully in the repository ({commit_oid}).')
+        save_last_push(local_shas)
 
-    # Step 7: Push the file to the repository
-    response = requests.put(url, headers=headers, json=data)
 
-    # Check if the file was updated/created successfully
-    if response.status_code in [200, 201]:
-        print(f'File {file_path_in_repo} updated successfully in the repository.')
-    else:
-        print(f'Failed to update the file {file_path_in_repo} in the repository.')
-        print('Response:', response.json())
+if __name__ == '__main__':
+    main()